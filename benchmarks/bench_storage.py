@@ -0,0 +1,404 @@
+"""Storage microbenchmarks for GlitchAI on a synthetic large database.
+
+Generates a ``glitchai_data.db`` at realistic scale (millions of
+``conversations`` rows, 100k users, thousands of facts for heavy users) and
+times every SQL path the bot runs, calling the real functions in bot.py:
+
+    get_conversation_history, get_user_facts, store_facts (the extract_facts
+    dedupe), export_conversations, get_user_data_counts (data management
+    screen), delete_user_data (confirm delete) and get_inactive_users (the
+    check-in scan), the incremental fact compaction of the users store_facts
+    touched (compact_facts) and the per-user fact cap (sweep_facts), plus the background purge of the deleted users'
+    rows (purge_deleted_batch until done, then incremental_vacuum).
+
+With --archive-days N, conversations idle for N days are first moved to the
+compressed archive (archive_conversations), so the same operations can be
+compared on a small hot table.
+
+Results are printed as JSON (and optionally written with --json) together
+with the schema's indexes and row counts, so schema and index changes can be
+compared run to run.
+
+Usage:
+    python benchmarks/bench_storage.py --json storage.json
+    python benchmarks/bench_storage.py --quick
+    python benchmarks/bench_storage.py --keep-db /tmp/big.db     # save the generated database
+    python benchmarks/bench_storage.py --db /tmp/big.db          # reuse it (a copy is benchmarked)
+    python benchmarks/bench_storage.py --db /tmp/big.db --archive-days 90
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import sqlite3
+import tempfile
+import time
+import uuid
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from common import import_bot, latency_summary_ms, peak_rss_mb
+
+WORDS = (
+    "python code bot project school math friend football music game idea help error function class "
+    "server data api telegram design app web image model train learn study exam weekend family coffee "
+    "travel algeria harrach csc match team goal night morning question answer build deploy fix bug"
+).split()
+
+CATEGORIES = ("personal", "preference", "interest", "opinion", "demographic")
+
+BATCH_SIZE = 50_000
+
+
+def sentence(rng, min_words, max_words):
+    return " ".join(rng.choice(WORDS) for _ in range(rng.randint(min_words, max_words)))
+
+
+def generate_database(bot, path, args):
+    """Create the bot's schema at path and fill it with synthetic data"""
+    rng = random.Random(args.seed)
+    bot.DB_PATH = str(path)
+    bot.setup_database()
+
+    now = datetime.now()
+    user_ids = list(range(1_000_000, 1_000_000 + args.users))
+    heavy_users = user_ids[:args.heavy_users]
+    typical_users = user_ids[args.heavy_users:]
+
+    conn = sqlite3.connect(path)
+    cursor = conn.cursor()
+    cursor.execute("PRAGMA synchronous = OFF")
+    cursor.execute("PRAGMA journal_mode = MEMORY")
+
+    # Users, with activity spread over the last 60 days so the inactivity scan has work to do
+    cursor.executemany(
+        """
+        INSERT INTO users (user_id, first_name, last_active, first_seen, total_messages)
+        VALUES (?, ?, ?, ?, ?)
+        """,
+        (
+            (
+                user_id,
+                f"User{user_id}",
+                now - timedelta(minutes=rng.randint(0, 60 * 24 * 60)),
+                now - timedelta(days=rng.randint(60, 400)),
+                0,
+            )
+            for user_id in user_ids
+        ),
+    )
+
+    # Facts: thousands for heavy users, a handful for everyone else
+    def facts():
+        for user_id in user_ids:
+            count = args.heavy_facts if user_id in heavy_set else rng.randint(0, args.facts_per_user * 2)
+            for _ in range(count):
+                yield (
+                    user_id,
+                    f"User {sentence(rng, 3, 10)}",
+                    None,
+                    round(rng.uniform(0.6, 1.0), 2),
+                    rng.choice(CATEGORIES),
+                    now - timedelta(days=rng.randint(0, 365)),
+                    now - timedelta(days=rng.randint(0, 30)) if rng.random() < 0.5 else None,
+                    rng.randint(0, 50),
+                )
+
+    heavy_set = set(heavy_users)
+    cursor.executemany(
+        """
+        INSERT INTO user_facts
+        (user_id, fact, source_message_id, confidence, category, timestamp, last_used, usage_count)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        """,
+        facts(),
+    )
+    max_fact_id = cursor.execute("SELECT COALESCE(MAX(id), 1) FROM user_facts").fetchone()[0]
+
+    # Conversations: heavy users get --heavy-share of all rows, grouped into conversations of 5-40 messages
+    state = {}
+    message_counts = {}
+
+    def conversation_rows():
+        start = now - timedelta(days=365)
+        step = timedelta(days=365) / max(args.rows, 1)
+        for n in range(args.rows):
+            if heavy_users and rng.random() < args.heavy_share:
+                user_id = rng.choice(heavy_users)
+            else:
+                user_id = rng.choice(typical_users)
+
+            conversation = state.get(user_id)
+            if conversation is None or conversation[2] == 0:
+                conversation = [str(uuid.UUID(int=rng.getrandbits(128))), 0, rng.randint(5, 40)]
+                state[user_id] = conversation
+            conversation[1] += 1
+            conversation[2] -= 1
+            message_counts[user_id] = message_counts.get(user_id, 0) + 1
+
+            fact_ids = [rng.randint(1, max_fact_id) for _ in range(rng.randint(0, 5))]
+            yield (
+                user_id,
+                conversation[0],
+                conversation[1],
+                start + step * n,
+                sentence(rng, 3, 25),
+                sentence(rng, 10, 80),
+                bot.pack_context({'history_included': True, 'fact_ids': fact_ids}),
+            )
+
+    rows = conversation_rows()
+    while True:
+        batch = [row for _, row in zip(range(BATCH_SIZE), rows)]
+        if not batch:
+            break
+        cursor.executemany(
+            """
+            INSERT INTO conversations
+            (user_id, conversation_id, message_number, timestamp, user_message, bot_response, context_ref)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            """,
+            batch,
+        )
+
+    cursor.executemany(
+        "UPDATE users SET total_messages = ? WHERE user_id = ?",
+        ((count, user_id) for user_id, count in message_counts.items())
+    )
+    conn.commit()
+    cursor.execute("ANALYZE")
+    conn.commit()
+    conn.close()
+
+
+def describe_database(path):
+    """Row counts, size and indexes, so results can be tied to a schema"""
+    conn = sqlite3.connect(path)
+    cursor = conn.cursor()
+    tables = [row[0] for row in cursor.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%' ORDER BY name"
+    )]
+    rows = {table: cursor.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0] for table in tables}
+    indexes = [
+        {"name": name, "table": table, "sql": sql}
+        for name, table, sql in cursor.execute(
+            "SELECT name, tbl_name, sql FROM sqlite_master WHERE type = 'index' ORDER BY tbl_name, name"
+        )
+    ]
+    conn.close()
+    return {
+        "size_mb": round(os.path.getsize(path) / (1024 * 1024), 1),
+        "rows": rows,
+        "indexes": indexes,
+    }
+
+
+def pick_users(path, args, rng):
+    """Sample heavy and typical users, with the latest conversation of each"""
+    conn = sqlite3.connect(path)
+    cursor = conn.cursor()
+    cursor.execute(
+        "SELECT user_id FROM users ORDER BY total_messages DESC LIMIT ?",
+        (max(args.heavy_users, 1),)
+    )
+    heavy = [row[0] for row in cursor.fetchall()][:args.samples]
+    cursor.execute("SELECT user_id FROM users WHERE total_messages > 0 ORDER BY RANDOM() LIMIT ?", (args.samples * 4,))
+    typical = [row[0] for row in cursor.fetchall() if row[0] not in set(heavy)][:args.samples]
+
+    latest = {}
+    for user_id in heavy + typical:
+        cursor.execute(
+            """
+            SELECT conversation_id, MAX(message_number) FROM conversations
+            WHERE user_id = ? GROUP BY conversation_id ORDER BY MAX(id) DESC LIMIT 1
+            """,
+            (user_id,)
+        )
+        row = cursor.fetchone()
+        if row:
+            latest[user_id] = row
+    conn.close()
+    rng.shuffle(typical)
+    return {"heavy": heavy, "typical": typical}, latest
+
+
+def time_calls(func, user_ids):
+    samples = []
+    for user_id in user_ids:
+        start = time.perf_counter()
+        func(user_id)
+        samples.append(time.perf_counter() - start)
+    return latency_summary_ms(samples)
+
+
+def run_operations(bot, path, args):
+    rng = random.Random(args.seed + 1)
+    bot.DB_PATH = str(path)
+    groups, latest = pick_users(path, args, rng)
+    loop = asyncio.new_event_loop()
+
+    for user_id, (conversation_id, message_count) in latest.items():
+        bot.conversation_contexts[user_id] = {
+            'conversation_id': conversation_id,
+            'message_count': message_count,
+            'context': [],
+            'facts_used': [],
+            'current_topics': []
+        }
+
+    def store_facts(user_id):
+        facts = [
+            {"fact": f"User {sentence(rng, 3, 10)}", "confidence": 0.8, "category": rng.choice(CATEGORIES)}
+            for _ in range(3)
+        ]
+        bot.store_facts(user_id, facts, None)
+
+    def export(user_id):
+        filename = loop.run_until_complete(bot.export_conversations(user_id))
+        if filename:
+            os.remove(filename)
+
+    operations = [
+        ("get_conversation_history", lambda user_id: bot.get_conversation_history(user_id, 5)),
+        ("get_user_facts", lambda user_id: bot.get_user_facts(user_id, 5)),
+        ("store_facts", store_facts),
+        ("get_user_data_counts", bot.get_user_data_counts),
+        ("export_conversations", export),
+        # Destructive, so it runs last
+        ("delete_user_data", bot.delete_user_data),
+    ]
+
+    # Steady state for fact compaction: only facts stored from here on are new
+    conn = sqlite3.connect(path)
+    conn.execute(
+        "INSERT OR REPLACE INTO maintenance_state (name, value) "
+        "SELECT name, (SELECT COALESCE(MAX(id), 0) FROM user_facts) "
+        "FROM (SELECT 'facts_compacted_id' AS name UNION ALL SELECT 'facts_swept_id')"
+    )
+    conn.commit()
+    conn.close()
+
+    results = {}
+    for name, func in operations:
+        if name == "delete_user_data":
+            # Compaction pass over the users store_facts just touched, before they're deleted
+            start = time.perf_counter()
+            users, merged = bot.compact_facts()
+            results["compact_facts"] = {
+                "all": latency_summary_ms([time.perf_counter() - start]), "users": users, "facts_merged": merged
+            }
+            start = time.perf_counter()
+            users, evicted = bot.sweep_facts()
+            results["sweep_facts"] = {
+                "all": latency_summary_ms([time.perf_counter() - start]), "users": users, "facts_evicted": evicted
+            }
+        results[name] = {group: time_calls(func, user_ids) for group, user_ids in groups.items()}
+
+    scan = []
+    for _ in range(args.scan_repeats):
+        start = time.perf_counter()
+        bot.get_inactive_users(datetime.now() - timedelta(days=1))
+        scan.append(time.perf_counter() - start)
+    results["get_inactive_users"] = {"all": latency_summary_ms(scan)}
+
+    # Background purge of everything delete_user_data tombstoned above
+    batches, purged = [], 0
+    while True:
+        start = time.perf_counter()
+        deleted = bot.purge_deleted_batch()
+        batches.append(time.perf_counter() - start)
+        purged += deleted
+        if not deleted:
+            break
+    start = time.perf_counter()
+    free_pages = bot.incremental_vacuum(1_000_000)
+    results["purge_deleted_batch"] = {"all": latency_summary_ms(batches), "rows": purged}
+    results["incremental_vacuum"] = {"all": latency_summary_ms([time.perf_counter() - start]), "free_pages_left": free_pages}
+
+    loop.close()
+    return results
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--users", type=int, default=100_000)
+    parser.add_argument("--rows", type=int, default=2_000_000, help="conversation rows")
+    parser.add_argument("--heavy-users", type=int, default=100)
+    parser.add_argument("--heavy-share", type=float, default=0.2, help="share of conversation rows from heavy users")
+    parser.add_argument("--heavy-facts", type=int, default=3_000, help="facts per heavy user")
+    parser.add_argument("--facts-per-user", type=int, default=5, help="mean facts per typical user")
+    parser.add_argument("--samples", type=int, default=50, help="users timed per group for each operation")
+    parser.add_argument("--scan-repeats", type=int, default=5)
+    parser.add_argument("--quick", action="store_true", help="10k users, 200k rows, 20 heavy users with 1000 facts")
+    parser.add_argument("--db", help="benchmark a copy of this database instead of generating one")
+    parser.add_argument("--keep-db", help="save the generated database here for later --db runs")
+    parser.add_argument("--archive-days", type=int, default=0, help="archive conversations idle this long first")
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--json", dest="json_path", help="also write the results to this file")
+    args = parser.parse_args(argv)
+    if args.quick:
+        args.users, args.rows, args.heavy_users, args.heavy_facts = 10_000, 200_000, 20, 1_000
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    json_path = Path(args.json_path).resolve() if args.json_path else None
+    source = Path(args.db).resolve() if args.db else None
+    keep = Path(args.keep_db).resolve() if args.keep_db else None
+
+    workdir = tempfile.mkdtemp(prefix="glitchai_storage_bench_")
+    bot = import_bot(workdir)
+    bot.STORAGE_BACKEND = "sqlite"  # The database is generated and inspected as one file
+    path = Path(bot.DB_PATH)
+
+    generation_seconds = None
+    if source:
+        shutil.copyfile(source, path)
+        bot.setup_database()  # Apply any schema migrations of the current code
+    else:
+        start = time.perf_counter()
+        generate_database(bot, path, args)
+        generation_seconds = round(time.perf_counter() - start, 1)
+        if keep:
+            shutil.copyfile(path, keep)
+
+    archive = None
+    if args.archive_days:
+        older_than = datetime.now() - timedelta(days=args.archive_days)
+        start = time.perf_counter()
+        archived = 0
+        while True:
+            moved = bot.archive_conversations(older_than)
+            archived += moved
+            if moved < bot.ARCHIVE_BATCH_SIZE:
+                break
+        archive = {"conversations": archived, "seconds": round(time.perf_counter() - start, 1)}
+        bot.incremental_vacuum(10_000_000)
+
+    database = describe_database(path)
+    operations = run_operations(bot, path, args)
+
+    results = {
+        "config": {
+            key: getattr(args, key)
+            for key in ("users", "rows", "heavy_users", "heavy_share", "heavy_facts", "facts_per_user", "samples", "seed")
+        },
+        "source_db": str(source) if source else None,
+        "generation_seconds": generation_seconds,
+        "archive": archive,
+        "database": database,
+        "operations_ms": operations,
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+        "sqlite_version": sqlite3.sqlite_version,
+        "workdir": workdir,
+    }
+    print(json.dumps(results, indent=2))
+    if json_path:
+        json_path.write_text(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
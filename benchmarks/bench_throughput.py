@@ -0,0 +1,447 @@
+"""Offline end-to-end throughput benchmark for GlitchAI.
+
+Drives the real handlers registered by ``bot.main()`` with synthetic
+Telethon-like events for N concurrent simulated users. Telegram and Gemini
+are replaced by stubs with configurable latency, and the bot runs against a
+fresh SQLite database in a temporary directory, so no live service or
+credential is needed.
+
+Usage:
+    python benchmarks/bench_throughput.py --users 50 --messages 20
+    python benchmarks/bench_throughput.py --latency-ms 800 --tokens 300 --json results.json
+    python benchmarks/bench_throughput.py --storage sharded --shards 8
+
+The stub model blocks the calling thread for ``--latency-ms`` like the real
+(synchronous) SDK does, so the numbers reflect how the bot behaves when
+Gemini is slow. With ``--workers N`` the bot runs in worker mode: the stub
+client stays in this (front) process and each worker process gets its own
+stub model.
+"""
+import argparse
+import asyncio
+import functools
+import itertools
+import logging
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+from common import import_bot, latency_summary_ms, peak_rss_mb
+
+
+# ---------------------------------------------------------------------------
+# Stub Gemini
+# ---------------------------------------------------------------------------
+
+class StubResponse:
+    def __init__(self, text, prompt_tokens, output_tokens):
+        self.text = text
+        self.usage_metadata = SimpleNamespace(
+            prompt_token_count=prompt_tokens,
+            candidates_token_count=output_tokens,
+            total_token_count=prompt_tokens + output_tokens,
+        )
+
+
+class StubChat:
+    def __init__(self, model, history=None):
+        self.model = model
+        self.history = list(history or [])
+
+    def send_message(self, content, **kwargs):
+        response = self.model.generate_content(content, **kwargs)
+        self.history.append({'role': 'user', 'parts': [content]})
+        self.history.append({'role': 'model', 'parts': [response.text]})
+        return response
+
+
+class StubModel:
+    """Stands in for genai.GenerativeModel with a fixed latency and output size"""
+
+    WORDS = ("sure", "nice", "cool", "python", "code", "friend", "idea", "great", "okay", "yes")
+
+    def __init__(self, latency_ms, tokens, jitter_ms=0):
+        self.latency = latency_ms / 1000
+        self.jitter = jitter_ms / 1000
+        self.tokens = tokens
+        self.calls = 0
+
+    def start_chat(self, history=None, **kwargs):
+        return StubChat(self, history)
+
+    def generate_content(self, contents, **kwargs):
+        self.calls += 1
+        prompt = contents if isinstance(contents, str) else json.dumps(contents, default=str)
+        delay = self.latency + (random.uniform(-self.jitter, self.jitter) if self.jitter else 0)
+        if delay > 0:
+            time.sleep(delay)  # The real SDK call is synchronous
+
+        if "Extract factual information" in prompt:
+            text = json.dumps([
+                {"fact": f"User mentioned {random.choice(self.WORDS)}", "confidence": 0.8, "category": "interest"}
+            ])
+            output_tokens = 20
+        else:
+            text = " ".join(random.choice(self.WORDS) for _ in range(self.tokens))
+            output_tokens = self.tokens
+        return StubResponse(text, len(prompt) // 4, output_tokens)
+
+
+def install_stub_model(latency_ms, tokens, jitter_ms):
+    """Worker process initializer: replace Gemini with the stub and keep logs quiet"""
+    import bot
+    logging.getLogger().setLevel(logging.WARNING)
+    bot.logger.setLevel(logging.WARNING)
+    bot.trace_logger.setLevel(logging.WARNING)
+    bot.model = bot.chat_model = StubModel(latency_ms, tokens, jitter_ms)
+
+
+# ---------------------------------------------------------------------------
+# Stub Telegram
+# ---------------------------------------------------------------------------
+
+class StubMessage:
+    def __init__(self, message_id, chat_id, text):
+        self.id = message_id
+        self.chat_id = chat_id
+        self.message = text
+        self.text = text
+        self.out = True
+        self.fwd_from = None
+
+
+class StubAction:
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+
+class StubClient:
+    """Implements the parts of TelegramClient the bot uses, with a fixed RPC latency"""
+
+    def __init__(self, rpc_ms):
+        self.rpc_latency = rpc_ms / 1000
+        self.handlers = []
+        self.sent = 0
+        self.edits = 0
+        self.message_ids = itertools.count(1)
+        self.ready = asyncio.Event()
+        self.disconnected = None
+
+    async def _rpc(self):
+        if self.rpc_latency:
+            await asyncio.sleep(self.rpc_latency)
+
+    # Lifecycle
+    def on(self, builder):
+        def decorator(callback):
+            self.add_event_handler(callback, builder)
+            return callback
+        return decorator
+
+    def add_event_handler(self, callback, builder):
+        if isinstance(builder, type):
+            builder = builder()  # @client.on(events.NewMessage) passes the class itself
+        builder.resolved = True  # No chats to resolve in the stub
+        self.handlers.append((builder, callback))
+
+    async def start(self, bot_token=None, **kwargs):
+        await self._rpc()
+        return self
+
+    async def connect(self):
+        await self._rpc()
+
+    def is_connected(self):
+        return self.disconnected is not None and not self.disconnected.done()
+
+    async def run_until_disconnected(self):
+        self.disconnected = asyncio.get_running_loop().create_future()
+        self.ready.set()
+        await self.disconnected
+
+    def disconnect(self):
+        if self.disconnected and not self.disconnected.done():
+            self.disconnected.set_result(None)
+
+    # RPCs
+    async def get_entity(self, user_id):
+        await self._rpc()
+        return SimpleNamespace(id=user_id, first_name=f"User{user_id}")
+
+    def action(self, chat, action):
+        return StubAction()
+
+    async def send_message(self, entity, message='', **kwargs):
+        await self._rpc()
+        self.sent += 1
+        return StubMessage(next(self.message_ids), entity, message)
+
+    async def edit_message(self, entity, message=None, text=None, **kwargs):
+        await self._rpc()
+        self.edits += 1
+        return StubMessage(message if isinstance(message, int) else next(self.message_ids), entity, text)
+
+    async def send_file(self, entity, file, caption=None, **kwargs):
+        await self._rpc()
+        self.sent += 1
+        return StubMessage(next(self.message_ids), entity, caption)
+
+
+class StubNewMessage:
+    """Synthetic events.NewMessage.Event for a private chat"""
+
+    def __init__(self, client, user_id, text):
+        self.client = client
+        self._client = client
+        self.sender_id = user_id
+        self.chat_id = user_id
+        self.text = text
+        self.raw_text = text
+        self.message = StubMessage(next(client.message_ids), user_id, text)
+        self.message.out = False
+        self.message.sender_id = user_id
+        self.id = self.message.id
+        self.document = None
+        self.photo = None
+        self.file = None
+        self.sender = SimpleNamespace(id=user_id, first_name=f"User{user_id}")
+        self.pattern_match = None
+
+    async def get_sender(self):
+        return self.sender
+
+    async def respond(self, message='', **kwargs):
+        return await self.client.send_message(self.chat_id, message, **kwargs)
+
+    async def reply(self, message='', **kwargs):
+        return await self.respond(message, **kwargs)
+
+
+class StubCallbackQuery:
+    """Synthetic events.CallbackQuery.Event for an inline button click"""
+
+    def __init__(self, client, user_id, data, message_id):
+        self.client = client
+        self._client = client
+        self.sender_id = user_id
+        self.chat_id = user_id
+        self.data = data
+        self.query = SimpleNamespace(data=data, chat_instance=0)
+        self.message_id = message_id
+        self.sender = SimpleNamespace(id=user_id, first_name=f"User{user_id}")
+        self.pattern_match = None
+        self.data_match = None
+        self.answered = False
+
+    async def get_sender(self):
+        return self.sender
+
+    async def answer(self, message=None, **kwargs):
+        await self.client._rpc()
+        self.answered = True
+
+    async def edit(self, text=None, **kwargs):
+        return await self.client.edit_message(self.chat_id, self.message_id, text, **kwargs)
+
+    async def respond(self, message='', **kwargs):
+        return await self.client.send_message(self.chat_id, message, **kwargs)
+
+
+async def dispatch(client, event):
+    """Run every registered handler whose builder accepts the event, like Telethon does"""
+    from telethon import events
+
+    kind = events.CallbackQuery if isinstance(event, StubCallbackQuery) else events.NewMessage
+    for builder, callback in client.handlers:
+        if not isinstance(builder, kind):
+            continue
+        accepted = builder.filter(event)
+        if asyncio.iscoroutine(accepted):
+            accepted = await accepted
+        if not accepted:
+            continue
+        try:
+            await callback(event)
+        except events.StopPropagation:
+            break
+
+
+# ---------------------------------------------------------------------------
+# Benchmark
+# ---------------------------------------------------------------------------
+
+async def simulate_user(bot, client, user_id, args, turn_latencies, menu_latencies, job_latencies, errors):
+    await dispatch(client, StubNewMessage(client, user_id, '/start'))
+    for n in range(args.messages):
+        if n % 4 == 3:  # Some turns say something about the user and pass the fact extraction gate
+            text = f"Message {n} from user {user_id}: by the way, I really like {random.choice(StubModel.WORDS)}"
+        else:
+            text = f"Message {n} from user {user_id}: tell me something about {random.choice(StubModel.WORDS)}"
+        start = time.perf_counter()
+        try:
+            await dispatch(client, StubNewMessage(client, user_id, text))
+        except Exception as e:
+            errors.append(type(e).__name__)
+            continue
+        turn_latencies.append(time.perf_counter() - start)
+
+        if args.menu_every and (n + 1) % args.menu_every == 0:
+            for data in (b"settings", b"data_management", b"view_data", b"back_to_menu"):
+                start = time.perf_counter()
+                await dispatch(client, StubCallbackQuery(client, user_id, data, next(client.message_ids)))
+                menu_latencies.append(time.perf_counter() - start)
+                job = bot.menu_jobs.get(user_id)
+                if job:
+                    # Read the result before moving on, so the job finishes instead of being cancelled
+                    await asyncio.wait({job[1]}, timeout=30)
+                    job_latencies.append(time.perf_counter() - start)
+
+        if args.think_ms:
+            await asyncio.sleep(random.uniform(0, 2 * args.think_ms) / 1000)
+
+
+async def run_benchmark(bot, args):
+    client = StubClient(args.rpc_ms)
+    bot.client = client
+    bot.model = bot.chat_model = StubModel(args.latency_ms, args.tokens, args.jitter_ms)
+    bot.loop_watchdog = bot.LoopWatchdog(threshold_ms=args.block_threshold_ms, strict_ms=args.strict_ms)
+    if not args.outbound_limits:
+        # Measure the bot, not Telegram's per-chat pacing of back-to-back simulated messages
+        bot.outbound.rate = bot.outbound.tokens = bot.outbound.chat_rate = float("inf")
+        bot.outbound.chat_burst = float("inf")
+    if args.workers:
+        bot.worker_pool = bot.WorkerPool(
+            args.workers,
+            initializer=functools.partial(install_stub_model, args.latency_ms, args.tokens, args.jitter_ms),
+        )
+
+    main_task = asyncio.create_task(bot.main())
+    await asyncio.wait_for(client.ready.wait(), timeout=60)
+
+    turn_latencies, menu_latencies, job_latencies, errors = [], [], [], []
+    users = [1_000_000 + i for i in range(args.users)]
+    start = time.perf_counter()
+    await asyncio.gather(*(
+        simulate_user(bot, client, user_id, args, turn_latencies, menu_latencies, job_latencies, errors)
+        for user_id in users
+    ))
+    elapsed = time.perf_counter() - start
+
+    # Let background work spawned by the turns (fact extraction...) settle before tearing down
+    pending = [t for t in asyncio.all_tasks() if t is not asyncio.current_task() and t is not main_task]
+    if pending:
+        await asyncio.wait(pending, timeout=args.drain_seconds)
+
+    client.disconnect()
+    strict_failure = None
+    try:
+        await main_task
+    except bot.LoopBlockedError as e:
+        strict_failure = str(e).splitlines()[0]
+    for task in asyncio.all_tasks():
+        if task is not asyncio.current_task():
+            task.cancel()
+
+    turns = len(turn_latencies)
+    return {
+        "config": {
+            "users": args.users,
+            "messages_per_user": args.messages,
+            "model_latency_ms": args.latency_ms,
+            "model_jitter_ms": args.jitter_ms,
+            "output_tokens": args.tokens,
+            "telegram_rpc_ms": args.rpc_ms,
+            "think_ms": args.think_ms,
+            "menu_every": args.menu_every,
+            "block_threshold_ms": args.block_threshold_ms,
+            "strict_ms": args.strict_ms,
+            "workers": args.workers,
+            "outbound_limits": args.outbound_limits,
+            "storage": args.storage if args.storage != "sharded" else f"sharded/{args.shards}",
+            "python": platform.python_version(),
+        },
+        "turns": turns,
+        "errors": len(errors),
+        "elapsed_seconds": round(elapsed, 3),
+        "messages_per_second": round(turns / elapsed, 2) if elapsed else 0.0,
+        "turn_latency_ms": latency_summary_ms(turn_latencies),
+        "menu_latency_ms": latency_summary_ms(menu_latencies),
+        "menu_job_latency_ms": latency_summary_ms(job_latencies),  # Click to finished background job
+        "model_calls": None if args.workers else bot.model.calls,  # Counted inside the workers otherwise
+        "telegram_messages_sent": client.sent,
+        "telegram_edits": client.edits,
+        "outbound_coalesced_edits": bot.OUTBOUND_COALESCED._value.get(),
+        "fact_gate_turns": {
+            decision: bot.FACT_GATE_TURNS.labels(decision)._value.get()
+            for decision in ("skipped", "buffered", "extracted")
+        },  # Decided inside the workers with --workers
+        "menu_jobs": {
+            outcome: bot.MENU_JOBS.labels("view_data", outcome)._value.get()
+            for outcome in ("done", "cancelled", "failed")
+        },
+        "startup": bot.startup_report.as_dict(),
+        "event_loop": {
+            "max_lag_ms": round(bot.loop_watchdog.max_lag * 1000, 2),
+            "blocks_over_threshold": len(bot.loop_watchdog.blocks),
+            "strict_failure": strict_failure,
+        },
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--users", type=int, default=20, help="concurrent simulated users")
+    parser.add_argument("--messages", type=int, default=10, help="chat messages sent by each user")
+    parser.add_argument("--latency-ms", type=float, default=50, help="stub model latency per call")
+    parser.add_argument("--jitter-ms", type=float, default=0, help="random +/- jitter on model latency")
+    parser.add_argument("--tokens", type=int, default=80, help="output tokens per stub model reply")
+    parser.add_argument("--rpc-ms", type=float, default=5, help="stub Telegram RPC latency")
+    parser.add_argument("--think-ms", type=float, default=0, help="mean pause between a user's messages")
+    parser.add_argument("--menu-every", type=int, default=0, help="click through the menu every K messages (0 disables)")
+    parser.add_argument("--block-threshold-ms", type=float, default=250, help="log loop blocks longer than this")
+    parser.add_argument("--strict-ms", type=float, default=0, help="fail the run on any loop block longer than this")
+    parser.add_argument("--drain-seconds", type=float, default=10, help="time allowed for background work at the end")
+    parser.add_argument("--workers", type=int, default=0, help="run in worker mode with N worker processes")
+    parser.add_argument("--outbound-limits", action="store_true",
+                        help="keep the OUTBOUND_* send rate limits (lifted by default)")
+    parser.add_argument("--storage", choices=("sqlite", "memory", "sharded"), default="sqlite",
+                        help="storage backend (STORAGE_BACKEND)")
+    parser.add_argument("--shards", type=int, default=4, help="database files of the sharded backend")
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--json", dest="json_path", help="also write the results to this file")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    random.seed(args.seed)
+    json_path = Path(args.json_path).resolve() if args.json_path else None
+
+    workdir = tempfile.mkdtemp(prefix="glitchai_bench_")
+    # Read at import, here and in worker processes
+    os.environ["STORAGE_BACKEND"] = args.storage
+    os.environ["STORAGE_SHARDS"] = str(args.shards)
+    bot = import_bot(workdir)
+
+    results = asyncio.run(run_benchmark(bot, args))
+    results["workdir"] = workdir
+
+    print(json.dumps(results, indent=2))
+    if json_path:
+        json_path.write_text(json.dumps(results, indent=2))
+    if results["event_loop"]["strict_failure"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+"""Helpers shared by the offline benchmarks."""
+import logging
+import math
+import os
+import resource
+import sys
+from pathlib import Path
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+
+
+def import_bot(workdir):
+    """Import bot.py with dummy credentials, running from workdir on a database inside it"""
+    # The bot validates these at import time; the benchmarks never talk to the real services
+    for name, value in (("API_ID", "1"), ("API_HASH", "bench"), ("BOT_TOKEN", "bench"), ("GEMINI_API_KEY", "bench")):
+        os.environ.setdefault(name, value)
+    os.environ.setdefault("HEALTH_PORT", "0")  # Any free port, so runs never collide
+
+    os.chdir(workdir)  # Database, exports and session files stay in the work dir
+    if str(REPO_ROOT) not in sys.path:
+        sys.path.insert(0, str(REPO_ROOT))
+
+    import bot
+    logging.getLogger().setLevel(logging.WARNING)
+    bot.logger.setLevel(logging.WARNING)
+    bot.trace_logger.setLevel(logging.WARNING)
+    bot.DB_PATH = str(Path(workdir) / "glitchai_data.db")
+    return bot
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, math.ceil(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def latency_summary_ms(samples):
+    """p50/p95/p99/max/mean of a list of durations in seconds, in milliseconds"""
+    return {
+        "count": len(samples),
+        "p50": round(percentile(samples, 50) * 1000, 3),
+        "p95": round(percentile(samples, 95) * 1000, 3),
+        "p99": round(percentile(samples, 99) * 1000, 3),
+        "max": round(max(samples, default=0) * 1000, 3),
+        "mean": round(sum(samples) / len(samples) * 1000, 3) if samples else 0.0,
+    }
+
+
+def peak_rss_mb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and kilobytes on Linux
+    return rss / (1024 * 1024) if sys.platform == 'darwin' else rss / 1024